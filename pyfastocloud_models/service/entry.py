@@ -1,4 +1,5 @@
 from enum import IntEnum
+from functools import lru_cache
 
 from bson import ObjectId
 from mongoengine import Document, ListField, EmbeddedDocumentField, ReferenceField, EmbeddedDocument, IntField, \
@@ -22,11 +23,14 @@ class ProviderPair(EmbeddedDocument):
         ADMIN = 3
 
         @classmethod
+        @lru_cache(maxsize=None)
         def choices(cls):
-            return [(choice, choice.name) for choice in cls]
+            return tuple((choice, choice.name) for choice in cls)
 
         @classmethod
         def coerce(cls, item):
+            if type(item) is int and item in cls._value2member_map_:
+                return cls._value2member_map_[item]
             return cls(int(item)) if not isinstance(item, cls) else item
 
         def __str__(self):
@@ -39,9 +43,7 @@ class ProviderPair(EmbeddedDocument):
 def safe_delete_stream(stream: IStream):
     if stream:
         from pyfastocloud_models.subscriber.entry import Subscriber
-        subscribers = Subscriber.objects()
-        for subscriber in subscribers:
-            subscriber.remove_official_stream(stream)
+        Subscriber.objects(streams__sid=stream.id).update(pull__streams__sid=stream.id)
         stream.delete()
 
 
@@ -1,5 +1,6 @@
 from datetime import datetime
 from enum import IntEnum
+from functools import lru_cache
 from urllib.parse import urlparse
 import os
 
@@ -111,11 +112,14 @@ class StreamLogLevel(IntEnum):
     LOG_LEVEL_DEBUG = 7
 
     @classmethod
+    @lru_cache(maxsize=None)
     def choices(cls):
-        return [(choice, choice.name) for choice in cls]
+        return tuple((choice, choice.name) for choice in cls)
 
     @classmethod
     def coerce(cls, item):
+        if type(item) is int and item in cls._value2member_map_:
+            return cls._value2member_map_[item]
         return cls(int(item)) if not isinstance(item, cls) else item
 
     def __str__(self):
@@ -149,19 +153,16 @@ class IStream(Document):
     def get_groups(self) -> list:
         return self.group.split(';')
 
-    def to_dict(self) -> dict:
-        return {StreamFields.NAME_FIELD: self.name, StreamFields.ID_FIELD: self.get_id(),
-                StreamFields.TYPE_FIELD: self.get_type(),
-                StreamFields.ICON_FIELD: self.tvg_logo, StreamFields.PRICE_FIELD: self.price,
-                StreamFields.VISIBLE_FIELD: self.visible,
-                StreamFields.IARC_FIELD: self.iarc, StreamFields.GROUP_FIELD: self.group}
+    # field names are bound as defaults so the serializer reads them as locals
+    def to_dict(self, _name=StreamFields.NAME_FIELD, _id=StreamFields.ID_FIELD, _type=StreamFields.TYPE_FIELD,
+                _icon=StreamFields.ICON_FIELD, _price=StreamFields.PRICE_FIELD, _visible=StreamFields.VISIBLE_FIELD,
+                _iarc=StreamFields.IARC_FIELD, _group=StreamFields.GROUP_FIELD) -> dict:
+        return {_name: self.name, _id: str(self.id), _type: self.get_type(), _icon: self.tvg_logo,
+                _price: self.price, _visible: self.visible, _iarc: self.iarc, _group: self.group}
 
     def to_front_dict(self) -> dict:
-        return {StreamFields.NAME_FIELD: self.name, StreamFields.ID_FIELD: self.get_id(),
-                StreamFields.TYPE_FIELD: self.get_type(),
-                StreamFields.ICON_FIELD: self.tvg_logo, StreamFields.PRICE_FIELD: self.price,
-                StreamFields.VISIBLE_FIELD: self.visible,
-                StreamFields.IARC_FIELD: self.iarc, StreamFields.GROUP_FIELD: self.group}
+        # base fields only, subclasses extend to_dict with runtime/vod data
+        return IStream.to_dict(self)
 
     def __init__(self, *args, **kwargs):
         super(IStream, self).__init__(*args, **kwargs)
@@ -196,14 +197,14 @@ class IStream(Document):
                 stream_type == constants.StreamType.ENCODE or stream_type == constants.StreamType.VOD_ENCODE or stream_type == constants.StreamType.COD_ENCODE or \
                 stream_type == constants.StreamType.PROXY or stream_type == constants.StreamType.VOD_PROXY or stream_type == constants.StreamType.VOD_ENCODE or \
                 stream_type == constants.StreamType.TIMESHIFT_PLAYER or stream_type == constants.StreamType.CATCHUP:
+            extinf = '#EXTINF:-1 tvg-id="{0}" tvg-name="{1}" tvg-logo="{2}" group-title="{3}",{4}\n'.format(
+                self.tvg_id,
+                self.tvg_name,
+                self.tvg_logo,
+                self.group,
+                self.name)
             for out in self.output.urls:
-                result += '#EXTINF:-1 tvg-id="{0}" tvg-name="{1}" tvg-logo="{2}" group-title="{3}",{4}\n{5}\n'.format(
-                    self.tvg_id,
-                    self.tvg_name,
-                    self.tvg_logo,
-                    self.group,
-                    self.name,
-                    out.uri)
+                result += '{0}{1}\n'.format(extinf, out.uri)
 
         return result
 
@@ -215,20 +216,19 @@ class IStream(Document):
                 stream_type == constants.StreamType.ENCODE or stream_type == constants.StreamType.VOD_ENCODE or stream_type == constants.StreamType.COD_ENCODE or \
                 stream_type == constants.StreamType.PROXY or stream_type == constants.StreamType.VOD_PROXY or stream_type == constants.StreamType.VOD_ENCODE or \
                 stream_type == constants.StreamType.TIMESHIFT_PLAYER or stream_type == constants.StreamType.CATCHUP:
+            # same for every output of the stream
+            extinf = '#EXTINF:-1 tvg-id="{0}" tvg-name="{1}" tvg-logo="{2}" group-title="{3}",{4}\n'.format(
+                self.tvg_id,
+                self.tvg_name,
+                self.tvg_logo,
+                self.group,
+                self.name)
+            url_prefix = 'http://{0}/{1}/{2}/{3}/{4}/'.format(lb_server_host_and_port, uid, passwd, did, self.id)
             for out in self.output.urls:
                 parsed_uri = urlparse(out.uri)
                 if parsed_uri.scheme == 'http' or parsed_uri.scheme == 'https':
                     file_name = os.path.basename(parsed_uri.path)
-                    url = 'http://{0}/{1}/{2}/{3}/{4}/{5}/{6}'.format(lb_server_host_and_port, uid, passwd, did,
-                                                                      self.id,
-                                                                      out.id, file_name)
-                    result += '#EXTINF:-1 tvg-id="{0}" tvg-name="{1}" tvg-logo="{2}" group-title="{3}",{4}\n{5}\n'.format(
-                        self.tvg_id,
-                        self.tvg_name,
-                        self.tvg_logo,
-                        self.group,
-                        self.name,
-                        url)
+                    result += '{0}{1}{2}/{3}\n'.format(extinf, url_prefix, out.id, file_name)
 
         return result
 
@@ -1,12 +1,23 @@
 from flask_login import UserMixin, login_user, logout_user
 
+import hmac
+import os
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from hashlib import md5
+from hashlib import md5, sha256
+from threading import Lock
+from time import monotonic
+from urllib.parse import quote
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHash
 from bson.objectid import ObjectId
 from enum import IntEnum
+from functools import lru_cache
 
 from mongoengine import Document, EmbeddedDocument, StringField, DateTimeField, IntField, ListField, ReferenceField, \
     PULL, ObjectIdField, BooleanField, EmbeddedDocumentListField
+from mongoengine.base.datastructures import EmbeddedDocumentList
 
 from pyfastocloud_models.service.entry import ServiceSettings
 from pyfastocloud_models.stream.entry import IStream, StreamFields
@@ -14,6 +25,51 @@ import pyfastocloud_models.constants as constants
 from pyfastocloud_models.utils.utils import date_to_utc_msec
 
 
+# default for UserStream.recent, means never watched
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_MSEC = 0
+
+# RFC 9106 low-memory profile, shared so parameters are not rebuilt per call
+_password_hasher = PasswordHasher(time_cost=3, memory_cost=65536, parallelism=4)
+# argon2 releases the GIL while hashing, so threads keep the KDF off the request handler
+_password_hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='password_hash')
+
+# successful verifications keyed by (stored hash, hmac of password), so repeated logins skip the KDF
+_VERIFIED_CACHE_SIZE = 4096
+_VERIFIED_CACHE_TTL_SEC = 5 * 60
+_verified_cache_secret = os.urandom(32)
+_verified_cache = OrderedDict()
+_verified_cache_lock = Lock()
+
+
+def _weak_password_hash(password: str) -> str:
+    return hmac.new(_verified_cache_secret, password.encode(), sha256).hexdigest()
+
+
+def _verify_cached(hash: str, weak_hash: str) -> bool:
+    key = (hash, weak_hash)
+    with _verified_cache_lock:
+        expire_time = _verified_cache.get(key)
+        if expire_time is None:
+            return False
+
+        if expire_time < monotonic():
+            del _verified_cache[key]
+            return False
+
+        _verified_cache.move_to_end(key)
+        return True
+
+
+def _cache_verified(hash: str, weak_hash: str):
+    key = (hash, weak_hash)
+    with _verified_cache_lock:
+        _verified_cache[key] = monotonic() + _VERIFIED_CACHE_TTL_SEC
+        _verified_cache.move_to_end(key)
+        if len(_verified_cache) > _VERIFIED_CACHE_SIZE:
+            _verified_cache.popitem(last=False)
+
+
 def login_user_wrap(user):
     login_user(user)
 
@@ -34,18 +90,21 @@ class Device(EmbeddedDocument):
         BANNED = 2
 
         @classmethod
+        @lru_cache(maxsize=None)
         def choices(cls):
-            return [(choice, choice.name) for choice in cls]
+            return tuple((choice, choice.name) for choice in cls)
 
         @classmethod
         def coerce(cls, item):
+            if type(item) is int and item in cls._value2member_map_:
+                return cls._value2member_map_[item]
             return cls(int(item)) if not isinstance(item, cls) else item
 
         def __str__(self):
             return str(self.value)
 
     meta = {'auto_create_index': True}
-    id = ObjectIdField(required=True, default=ObjectId, unique=True, primary_key=True)
+    id = ObjectIdField(required=True, default=ObjectId, primary_key=True)
     created_date = DateTimeField(default=datetime.now)
     status = IntField(default=Status.NOT_ACTIVE)
     name = StringField(default=DEFAULT_DEVICE_NAME, min_length=MIN_DEVICE_NAME_LENGTH,
@@ -54,9 +113,11 @@ class Device(EmbeddedDocument):
     def get_id(self):
         return str(self.id)
 
-    def to_dict(self) -> dict:
-        return {Device.ID_FIELD: self.get_id(), Device.NAME_FIELD: self.name, Device.STATUS_FIELD: self.status,
-                Device.CREATED_DATE_FIELD: date_to_utc_msec(self.created_date)}
+    # field names are bound as defaults so the serializers read them as locals
+    def to_dict(self, _id=ID_FIELD, _name=NAME_FIELD, _status=STATUS_FIELD, _created_date=CREATED_DATE_FIELD,
+                _to_msec=date_to_utc_msec) -> dict:
+        return {_id: str(self.id), _name: self.name, _status: self.status,
+                _created_date: _to_msec(self.created_date)}
 
 
 class UserStream(EmbeddedDocument):
@@ -67,24 +128,34 @@ class UserStream(EmbeddedDocument):
     sid = ReferenceField(IStream, required=True)
     favorite = BooleanField(default=False)
     private = BooleanField(default=False)
-    recent = DateTimeField(default=datetime.utcfromtimestamp(0))
+    recent = DateTimeField(default=_EPOCH)
     interruption_time = IntField(default=0, min_value=0, max_value=constants.MAX_VIDEO_DURATION_MSEC, required=True)
 
     def get_id(self):
-        return str(self.sid.id)
+        return str(self.get_stream_id())
+
+    def get_stream_id(self) -> ObjectId:
+        # raw id of the referenced stream, without dereferencing it
+        sid = self._data.get('sid')
+        return sid if isinstance(sid, ObjectId) else sid.id
 
-    def to_dict(self) -> dict:
+    def recent_utc_msec(self) -> int:
+        recent = self.recent
+        return _EPOCH_MSEC if recent == _EPOCH else date_to_utc_msec(recent)
+
+    # field names are bound as defaults so the serializers read them as locals
+    def to_dict(self, _favorite=FAVORITE_FIELD, _private=PRIVATE_FIELD, _recent=RECENT_FIELD) -> dict:
         res = self.sid.to_dict()
-        res[UserStream.FAVORITE_FIELD] = self.favorite
-        res[UserStream.PRIVATE_FIELD] = self.private
-        res[UserStream.RECENT_FIELD] = date_to_utc_msec(self.recent)
+        res[_favorite] = self.favorite
+        res[_private] = self.private
+        res[_recent] = self.recent_utc_msec()
         return res
 
-    def to_front_dict(self):
+    def to_front_dict(self, _favorite=FAVORITE_FIELD, _private=PRIVATE_FIELD, _recent=RECENT_FIELD):
         res = self.sid.to_front_dict()
-        res[UserStream.FAVORITE_FIELD] = self.favorite
-        res[UserStream.PRIVATE_FIELD] = self.private
-        res[UserStream.RECENT_FIELD] = date_to_utc_msec(self.recent)
+        res[_favorite] = self.favorite
+        res[_private] = self.private
+        res[_recent] = self.recent_utc_msec()
         return res
 
 
@@ -103,34 +174,49 @@ class Subscriber(UserMixin, Document):
         DELETED = 2
 
         @classmethod
+        @lru_cache(maxsize=None)
         def choices(cls):
-            return [(choice, choice.name) for choice in cls]
+            return tuple((choice, choice.name) for choice in cls)
 
         @classmethod
         def coerce(cls, item):
+            if type(item) is int and item in cls._value2member_map_:
+                return cls._value2member_map_[item]
             return cls(int(item)) if not isinstance(item, cls) else item
 
         def __str__(self):
             return str(self.value)
 
-    SUBSCRIBER_HASH_LENGTH = 32
+    MD5_HASH_LENGTH = 32  # legacy hashes
+    SUBSCRIBER_HASH_LENGTH = 128
 
-    meta = {'allow_inheritance': False, 'collection': 'subscribers', 'auto_create_index': False}
+    # uniqueness inside the lists is kept by the atomic updates in add_*, not by unique indexes
+    meta = {'allow_inheritance': False, 'collection': 'subscribers', 'auto_create_index': False,
+            'indexes': [{'fields': ['streams.sid'], 'sparse': True}]}
 
     email = StringField(max_length=64, required=True)
     first_name = StringField(max_length=64, required=True)
     last_name = StringField(max_length=64, required=True)
-    password = StringField(min_length=SUBSCRIBER_HASH_LENGTH, max_length=SUBSCRIBER_HASH_LENGTH, required=True)
+    password = StringField(min_length=MD5_HASH_LENGTH, max_length=SUBSCRIBER_HASH_LENGTH, required=True)
     created_date = DateTimeField(default=datetime.now)
     exp_date = DateTimeField(default=MAX_DATE)
     status = IntField(default=Status.NOT_ACTIVE)
     country = StringField(min_length=2, max_length=3, required=True)
     language = StringField(default=constants.DEFAULT_LOCALE, required=True)
 
-    servers = ListField(ReferenceField(ServiceSettings, reverse_delete_rule=PULL), unique=True, default=[])
-    devices = EmbeddedDocumentListField(Device, unique=True, default=[])
+    servers = ListField(ReferenceField(ServiceSettings, reverse_delete_rule=PULL), default=list)
+    devices = EmbeddedDocumentListField(Device, default=list)
     max_devices_count = IntField(default=constants.DEFAULT_DEVICES_COUNT)
-    streams = EmbeddedDocumentListField(UserStream, unique=True, default=[])
+    streams = EmbeddedDocumentListField(UserStream, default=list)
+
+    def __init__(self, *args, **kwargs):
+        super(Subscriber, self).__init__(*args, **kwargs)
+        self._reset_caches()
+
+    def __setstate__(self, data):
+        # the lookup caches are not part of the pickled state
+        super(Subscriber, self).__setstate__(data)
+        self._reset_caches()
 
     def created_date_utc_msec(self):
         return date_to_utc_msec(self.created_date)
@@ -139,29 +225,58 @@ class Subscriber(UserMixin, Document):
         return date_to_utc_msec(self.exp_date)
 
     def add_server(self, server: ServiceSettings):
-        self.servers.append(server)
-        self.save()
+        if self.id is None:
+            if server not in self.servers:
+                self._append_unsaved('servers', [server])
+            return
+
+        result = Subscriber.objects(id=self.id).update_one(add_to_set__servers=server, full_result=True)
+        if result.modified_count:
+            self._append_stored('servers', server)
 
     def add_device(self, device: Device):
-        if len(self.devices) < self.max_devices_count:
-            self.devices.append(device)
-            self.save()
+        if self.max_devices_count <= 0:
+            return
+
+        if self.id is None:
+            if len(self.devices) < self.max_devices_count:
+                self._append_unsaved('devices', [device])
+            return
+
+        # matches only while devices has less than max_devices_count elements
+        free_slot = {'devices.{0}'.format(self.max_devices_count - 1): {'$exists': False}}
+        if Subscriber.objects(id=self.id, __raw__=free_slot).update_one(push__devices=device):
+            self._append_stored('devices', device)
 
     def remove_device(self, sid: ObjectId):
-        devices = self.devices.filter(id=sid)
-        devices.delete()
+        index = self._device_index(sid)
+        if index is None:
+            return
+
+        del self.devices[index]
+        self._reset_caches()
         self.devices.save()
 
     def generate_playlist(self, did: str, lb_server_host_and_port: str) -> str:
-        result = '#EXTM3U\n'
+        parts = ['#EXTM3U\n']
+        append = parts.append
         sid = str(self.id)
-        for stream in self.streams:
+        passwd = quote(self.password, safe='')
+        user_streams = self._data['streams']
+        # one query for all referenced streams instead of dereferencing the embedded list
+        ids = [stream.get_stream_id() for stream in user_streams]
+        db_streams = {stream.id: stream for stream in IStream.objects(id__in=ids)}
+        for stream in user_streams:
+            db_stream = db_streams.get(stream.get_stream_id())
+            if not db_stream:
+                continue
+
             if stream.private:
-                result += stream.sid.generate_playlist(False)
+                append(db_stream.generate_playlist(False))
             else:
-                result += stream.sid.generate_device_playlist(sid, self.password, did, lb_server_host_and_port, False)
+                append(db_stream.generate_device_playlist(sid, passwd, did, lb_server_host_and_port, False))
 
-        return result
+        return ''.join(parts)
 
     def all_streams(self):
         return self.streams
@@ -171,49 +286,176 @@ class Subscriber(UserMixin, Document):
         self.add_official_stream(user_stream)
 
     def add_official_stream(self, stream: UserStream):
-        db_stream = stream.sid
-        found_streams = self.streams.filter(sid=db_stream)
-        if not found_streams:
-            self.streams.append(stream)
-            self.save()
+        self._push_stream(stream)
+
+    def add_official_streams(self, streams: list):
+        new_streams = []
+        new_sids = set()
+        for stream in streams:
+            sid = stream.get_stream_id()
+            if sid not in new_sids and self._stream_index(sid) is None:
+                new_sids.add(sid)
+                new_streams.append(stream)
+
+        if not new_streams:
+            return
+
+        if self.id is None:
+            self._append_unsaved('streams', new_streams)
+            return
+
+        # the filter doesn't match if any of the streams is already stored, then add them one by one
+        sids = [stream.get_stream_id() for stream in new_streams]
+        if Subscriber.objects(id=self.id, streams__sid__nin=sids).update_one(push_all__streams=new_streams):
+            for stream in new_streams:
+                self._append_stored('streams', stream)
+        else:
+            for stream in new_streams:
+                self._push_stream(stream)
 
     def add_own_stream(self, stream: IStream):
-        user_stream = UserStream(sid=stream.id)
-        user_stream.private = True
-        found_streams = self.streams.filter(sid=stream)
-        if not found_streams:
-            self.streams.append(user_stream)
-            self.save()
+        self._push_stream(UserStream(sid=stream.id, private=True))
 
     def remove_official_stream(self, stream: IStream):
-        streams = self.streams.filter(sid=stream)
-        streams.delete()
-        self.streams.save()
+        if stream:
+            self.remove_official_stream_by_id(stream.id)
 
     def remove_official_stream_by_id(self, sid: ObjectId):
-        original_stream = IStream.objects(id=sid).first()
-        self.remove_official_stream(original_stream)
+        index = self._stream_index(sid)
+        if index is None:
+            return
 
-    def remove_own_stream_by_id(self, sid: ObjectId):
-        stream = IStream.objects(id=sid).first()
-        streams = self.streams.filter(sid=stream, private=True)
-        for stream in streams:
-            stream.sid.delete()
-        streams.delete()
+        del self.streams[index]
+        self._reset_caches()
         self.streams.save()
 
+    def remove_own_stream_by_id(self, sid: ObjectId):
+        index = self._stream_index(sid)
+        if index is None or not self._data['streams'][index].private:
+            return
+
+        IStream.objects(id=sid).delete()
+        Subscriber.objects(id=self.id).update_one(pull__streams__sid=sid)
+        self._remove_stored('streams', index)
+
     def remove_all_own_streams(self):
-        streams = self.streams.filter(private=True)
-        for stream in streams:
-            stream.sid.delete()
-        streams.delete()
-        self.streams.save()
+        own_ids = [stream.get_stream_id() for stream in self._data['streams'] if stream.private]
+        if not own_ids:
+            return
+
+        IStream.objects(id__in=own_ids).delete()
+        Subscriber.objects(id=self.id).update_one(pull__streams__sid__in=own_ids)
+        self._data['streams'] = [stream for stream in self._data['streams'] if not stream.private]
+        self._reset_caches()
 
     def official_streams(self):
-        return self.streams.filter(private=False)
+        return self._split_streams()[0]
 
     def own_streams(self):
-        return self.streams.filter(private=True)
+        return self._split_streams()[1]
+
+    def official_streams_as_pymongo(self) -> list:
+        return self._streams_as_pymongo(False)
+
+    def own_streams_as_pymongo(self) -> list:
+        return self._streams_as_pymongo(True)
+
+    def _streams_as_pymongo(self, private: bool) -> list:
+        sids = [stream.get_stream_id() for stream in self._data['streams'] if stream.private == private]
+        docs = {doc['_id']: doc for doc in IStream.objects(id__in=sids).as_pymongo()}
+        return [docs[sid] for sid in sids if sid in docs]
+
+    def _push_stream(self, stream: UserStream):
+        sid = stream.get_stream_id()
+        if self._stream_index(sid) is not None:
+            return
+
+        if self.id is None:
+            self._append_unsaved('streams', [stream])
+            return
+
+        # the filter doesn't match if the stream is already in the list, so the check and push are atomic
+        if Subscriber.objects(id=self.id, streams__sid__ne=sid).update_one(push__streams=stream):
+            self._append_stored('streams', stream)
+
+    def _append_stored(self, field: str, value):
+        # value is already stored by an atomic update, keep the loaded copy in sync without marking it changed
+        self._check_caches()
+        values = self._data[field]
+        list.append(values, value)
+        if field == 'streams':
+            if self._streams_index is not None:
+                self._streams_index[value.get_stream_id()] = len(values) - 1
+        elif field == 'devices':
+            if self._devices_index is not None:
+                self._devices_index[value.id] = len(values) - 1
+        self._cached_lists = self._lists_snapshot()
+
+    def _append_unsaved(self, field: str, values: list):
+        # no stored document to update yet, append and save the whole document
+        getattr(self, field).extend(values)
+        self.save()
+
+    def _remove_stored(self, field: str, index: int):
+        # counterpart of _append_stored for elements already removed by an atomic update
+        list.__delitem__(self._data[field], index)
+        self._reset_caches()
+
+    # lookup caches over the embedded lists, rebuilt lazily after any change to them
+    def _reset_caches(self):
+        self._cached_lists = None
+        self._streams_index = None
+        self._devices_index = None
+
+    def _lists_snapshot(self) -> tuple:
+        # raw lists, reading them through the fields would dereference every stream
+        streams = self._data['streams']
+        devices = self._data['devices']
+        return streams, len(streams), devices, len(devices)
+
+    def _check_caches(self):
+        # also catches changes made to the lists outside of the methods of this class
+        snapshot = self._lists_snapshot()
+        cached = self._cached_lists
+        if not cached or cached[0] is not snapshot[0] or cached[1] != snapshot[1] or cached[2] is not snapshot[2] or \
+                cached[3] != snapshot[3]:
+            self._reset_caches()
+            self._cached_lists = snapshot
+
+    @property
+    def _streams_by_sid(self) -> dict:
+        self._check_caches()
+        if self._streams_index is None:
+            self._streams_index = {stream.get_stream_id(): i for i, stream in enumerate(self._data['streams'])}
+        return self._streams_index
+
+    @property
+    def _devices_by_id(self) -> dict:
+        self._check_caches()
+        if self._devices_index is None:
+            self._devices_index = {device.id: i for i, device in enumerate(self._data['devices'])}
+        return self._devices_index
+
+    # positions go stale when elements are reordered or edited in place, confirm them before use
+    def _stream_index(self, sid: ObjectId):
+        index = self._streams_by_sid.get(sid)
+        if index is not None and self._data['streams'][index].get_stream_id() != sid:
+            self._reset_caches()
+            index = self._streams_by_sid.get(sid)
+        return index
+
+    def _device_index(self, did: ObjectId):
+        index = self._devices_by_id.get(did)
+        if index is not None and self._data['devices'][index].id != did:
+            self._reset_caches()
+            index = self._devices_by_id.get(did)
+        return index
+
+    def _split_streams(self) -> tuple:
+        official, own = [], []
+        for stream in self.streams:
+            (own if stream.private else official).append(stream)
+        return EmbeddedDocumentList(official, self, 'streams'), EmbeddedDocumentList(own, self, 'streams')
 
     def delete(self, *args, **kwargs):
         self.remove_all_own_streams()
@@ -222,21 +464,73 @@ class Subscriber(UserMixin, Document):
 
     @staticmethod
     def make_md5_hash_from_password(password: str) -> str:
-        m = md5()
-        m.update(password.encode())
-        return m.hexdigest()
+        # still authenticates legacy accounts, usedforsecurity=False only keeps it working on FIPS builds
+        return md5(password.encode(), usedforsecurity=False).hexdigest()
 
     @staticmethod
     def generate_password_hash(password: str) -> str:
-        return Subscriber.make_md5_hash_from_password(password)
+        return _password_hasher.hash(password)
+
+    @staticmethod
+    def generate_password_hashes(passwords: list) -> list:
+        return list(_password_hash_executor.map(Subscriber.generate_password_hash, passwords))
 
     @staticmethod
     def check_password_hash(hash: str, password: str) -> bool:
-        return hash == Subscriber.generate_password_hash(password)
+        weak_hash = _weak_password_hash(password)
+        if _verify_cached(hash, weak_hash):
+            return True
+
+        return Subscriber._verify_password_hash(hash, password, weak_hash)
+
+    def check_password(self, password: str) -> bool:
+        if not Subscriber.check_password_hash(self.password, password):
+            return False
+
+        # upgrade legacy md5 and outdated argon2 parameters on a successful login
+        if len(self.password) == Subscriber.MD5_HASH_LENGTH or _password_hasher.check_needs_rehash(self.password):
+            self._store_password_hash(Subscriber.generate_password_hash(password))
+        return True
+
+    def _store_password_hash(self, hash: str):
+        if self.id is None:
+            self.password = hash
+            return
+
+        Subscriber.objects(id=self.id).update_one(set__password=hash)
+        self._data['password'] = hash
+
+    @staticmethod
+    def generate_password_hash_async(password: str) -> Future:
+        return _password_hash_executor.submit(Subscriber.generate_password_hash, password)
+
+    @staticmethod
+    def check_password_hash_async(hash: str, password: str) -> Future:
+        weak_hash = _weak_password_hash(password)
+        if _verify_cached(hash, weak_hash):
+            future = Future()
+            future.set_result(True)
+            return future
+
+        return _password_hash_executor.submit(Subscriber._verify_password_hash, hash, password, weak_hash)
+
+    @staticmethod
+    def _verify_password_hash(hash: str, password: str, weak_hash: str) -> bool:
+        if len(hash) == Subscriber.MD5_HASH_LENGTH:
+            verified = hmac.compare_digest(hash.encode(), Subscriber.make_md5_hash_from_password(password).encode())
+        else:
+            try:
+                verified = _password_hasher.verify(hash, password)
+            except (VerificationError, InvalidHash):
+                verified = False
+
+        if verified:
+            _cache_verified(hash, weak_hash)
+        return verified
 
     @classmethod
     def make_subscriber(cls, email: str, first_name: str, last_name: str, password: str, country: str, language: str,
                         exp_date=MAX_DATE):
         return cls(email=email, first_name=first_name, last_name=last_name,
-                   password=Subscriber.make_md5_hash_from_password(password), country=country,
+                   password=Subscriber.generate_password_hash(password), country=country,
                    language=language, exp_date=exp_date)
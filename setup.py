@@ -17,11 +17,11 @@ DESCRIPTION = 'FastoCloud python models files.'
 URL = 'https://github.com/fastogt/pyfastocloud_models'
 EMAIL = 'support@fastogt.com'
 AUTHOR = 'Alexandr Topilski'
-REQUIRES_PYTHON = '>=3.0.0'
+REQUIRES_PYTHON = '>=3.9.0'
 VERSION = '1.0.0'
 
 # What packages are required for this module to be executed?
-REQUIRED = ['mongoengine']
+REQUIRED = ['mongoengine', 'argon2-cffi']
 
 # The rest you shouldn't have to touch too much :)
 # ------------------------------------------------
@@ -107,7 +107,7 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.0',
+        'Programming Language :: Python :: 3.9',
         'Programming Language :: Python :: Implementation :: CPython',
         'Programming Language :: Python :: Implementation :: PyPy'
     ],